@@ -1,17 +1,29 @@
+import collections
 import datetime
 import decimal
+import heapq
+import html
 import logging
+import math
 import os
 import queue
 import random
+import re
 import threading
 
+from typing import DefaultDict, Optional
+
+import requests
 from flask import Flask, request
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, ForceReply, Bot
-from telegram.ext import CallbackContext, CallbackQueryHandler, CommandHandler, Dispatcher, MessageHandler, Filters
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import (CallbackContext, CallbackQueryHandler, CommandHandler, Dispatcher, MessageHandler, Filters,
+                          MessageFilter)
 from telegram.user import User
 
 import persistence
+import recording
+from records import Bill, MonthStats, Payment
 
 DATA_REGISTER = "r"
 DATA_PAYMENT_DELETE = "pd"
@@ -27,14 +39,160 @@ DATA_BILL_DELETE = "bd"
 DATA_BILL_DELETE_YES = "by"
 DATA_BILL_REDISPLAY = "br"
 
+# Participant and payer pickers show this many users per page, laid out in this many columns
+ROSTER_COLUMNS = 2
+ROSTER_PAGE_SIZE = 16
+
+# Rapid taps on the same message are coalesced so that only the latest state is sent after this many seconds
+EDIT_DEBOUNCE_SECONDS = 0.8
+
+# Most recent matching bills listed by /find
+FIND_LIMIT = 10
+
+# /stats lists the top categories of at most this many months
+STATS_TOP_CATEGORIES = 3
+STATS_MONTHS = 12
+
 URL = os.environ.get("URL")
 TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 PORT = int(os.environ.get('PORT', '8443'))
 
-persistence = persistence.MongoPersistence()
-bot = Bot(token=TOKEN)
-update_queue = queue.Queue()
-dispatcher = Dispatcher(bot, update_queue, persistence=persistence)
+# Times an update is handled again after its write lost to another instance
+CONFLICT_RETRIES = 3
+FORWARDED_HEADER = "X-Bob-Forwarded"
+
+
+# Ids of updates handled here even if another instance holds the lease of their chat: those forwarded here by the
+# instance that received them, and those that could not be forwarded
+local_updates: set[int] = set()
+
+
+def forward_update(owner_url: str, data: dict) -> bool:
+    try:
+        requests.post(owner_url + TOKEN, json=data, headers={FORWARDED_HEADER: "1"}, timeout=5).raise_for_status()
+        return True
+    except requests.RequestException as e:
+        logging.log(logging.WARNING, f"Could not forward update to {owner_url}, handling it here: {e}")
+        return False
+
+
+class TrackingBot(Bot):
+    """Keeps track of the messages the current thread sends and edits while handling an update, so that an attempt
+    whose write was lost can be undone before the update is handled again."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tracked = threading.local()
+
+    def start_attempt(self, retry: bool = False):
+        self.tracked.retry = retry
+        self.tracked.failed = False
+        # (chat_id, message_id) of each message sent and edited
+        self.tracked.sent = []
+        self.tracked.edited = set()
+
+    def stop_tracking(self):
+        self.tracked.sent = None
+
+    def is_tracking(self) -> bool:
+        return getattr(self.tracked, "sent", None) is not None
+
+    def note_error(self):
+        if self.is_tracking():
+            self.tracked.failed = True
+
+    def note_edit(self, chat_id: int, message_id: int):
+        if self.is_tracking():
+            self.tracked.edited.add((chat_id, message_id))
+
+    def _post(self, endpoint: str, data: dict = None, *args, **kwargs):
+        if not self.is_tracking():
+            return super()._post(endpoint, data, *args, **kwargs)
+        if self.tracked.retry and endpoint == "answerCallbackQuery":
+            # Answered by the first attempt already, and Telegram rejects answering a callback query twice
+            return True
+        result = super()._post(endpoint, data, *args, **kwargs)
+        if endpoint == "sendMessage" and isinstance(result, dict):
+            self.tracked.sent.append((result["chat"]["id"], result["message_id"]))
+        elif endpoint.startswith("editMessage") and data and "message_id" in data:
+            self.note_edit(data["chat_id"], data["message_id"])
+        return result
+
+
+class RetryingDispatcher(Dispatcher):
+    def process_update(self, update: object) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            super().process_update(update)
+            return
+        # The lease may have moved to another instance while the update was queued
+        if update.update_id in local_updates:
+            local_updates.discard(update.update_id)
+        else:
+            owner_url = self.persistence.get_chat_owner(chat.id)
+            if owner_url is not None and forward_update(owner_url, update.to_dict()):
+                return
+        try:
+            self.bot.start_attempt()
+            super().process_update(update)
+            retried = False
+            lost_edits = set()
+            for _ in range(CONFLICT_RETRIES):
+                if not self.persistence.pop_conflict(chat.id):
+                    break
+                # The chat has been reloaded from the database, so handle the update again on top of the latest data.
+                # Messages sent the first time may show bill ids that now belong to other bills, so they go first.
+                self.delete_messages(self.bot.tracked.sent)
+                lost_edits |= self.bot.tracked.edited
+                logging.log(logging.INFO, f"Retrying update {update.update_id} for chat {chat.id} after a conflict")
+                retried = True
+                self.bot.start_attempt(retry=True)
+                super().process_update(update)
+            else:
+                if self.persistence.pop_conflict(chat.id):
+                    self.delete_messages(self.bot.tracked.sent)
+                    self.restore_messages(update, lost_edits | self.bot.tracked.edited)
+                    logging.log(logging.ERROR,
+                                f"Dropped update {update.update_id} for chat {chat.id} after repeated conflicts")
+                    return
+            if retried:
+                # Edits from lost attempts that the last one did not make again
+                self.restore_messages(update, lost_edits - self.bot.tracked.edited)
+                if self.bot.tracked.failed:
+                    logging.log(logging.ERROR,
+                                f"Dropped update {update.update_id} for chat {chat.id} after its retry failed")
+        finally:
+            self.bot.stop_tracking()
+
+    def dispatch_error(self, update: Optional[object], error: Exception, promise=None) -> None:
+        self.bot.note_error()
+        super().dispatch_error(update, error, promise)
+
+    def delete_messages(self, messages: list[tuple[int, int]]):
+        for chat_id, message_id in messages:
+            try:
+                self.bot.delete_message(chat_id=chat_id, message_id=message_id)
+            except TelegramError as e:
+                logging.log(logging.WARNING,
+                            f"Could not delete message {message_id} in chat {chat_id} sent before a conflict: {e}")
+
+    def restore_messages(self, update: Update, messages: set[tuple[int, int]]):
+        # Only the message whose button was pressed is known as it was before the update
+        original = update.callback_query.message if update.callback_query is not None else None
+        for chat_id, message_id in messages:
+            if original is None or original.text is None or (chat_id, message_id) != (original.chat_id,
+                                                                                       original.message_id):
+                logging.log(logging.WARNING, f"Message {message_id} in chat {chat_id} still shows an edit from "
+                                             f"update {update.update_id}, which was lost in a conflict")
+                continue
+            drop_pending_edit(chat_id, message_id)
+            try:
+                self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=original.text_html,
+                                           parse_mode=ParseMode.HTML, reply_markup=original.reply_markup)
+            except TelegramError as e:
+                logging.log(logging.WARNING,
+                            f"Could not restore message {message_id} in chat {chat_id} after a conflict: {e}")
+
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
@@ -44,6 +202,81 @@ keyboard_register = [
 
 markup_register = InlineKeyboardMarkup(keyboard_register)
 
+# Registered users of each chat sorted by full name, as (registered list, sorted list, lookup by user id). Built lazily
+# from get_member and dropped whenever someone joins, leaves or registers. Rebuilt when a registered user reading it is
+# seen with a different name, or when a chat reloaded from the database has a new registered list.
+rosters: dict[int, tuple[list[int], list[User], dict[int, User]]] = {}
+
+
+class BillIndex:
+    """Inverted index of a chat's bills for /find, by the words of their descriptions and the names of their payers and
+    participants. Bills are indexed by user id and names are kept per user, so that a rename only updates that user."""
+    __slots__ = ("bills", "bill_ids", "user_bill_ids", "bill_keys", "names", "user_ids", "unnamed", "roster")
+
+    def __init__(self, bills: dict[int, Bill]):
+        self.bills = bills
+        # Bill ids by description word and by payer or participant
+        self.bill_ids: DefaultDict[str, set[int]] = collections.defaultdict(set)
+        self.user_bill_ids: DefaultDict[int, set[int]] = collections.defaultdict(set)
+        # Description words and user ids of each indexed bill
+        self.bill_keys: dict[int, tuple[set[str], set[int]]] = {}
+        # Name terms of each user with the User they were taken from, and user ids by name term
+        self.names: dict[int, tuple[User, set[str]]] = {}
+        self.user_ids: DefaultDict[str, set[int]] = collections.defaultdict(set)
+        # Users on indexed bills whose names have not been looked up yet
+        self.unnamed: set[int] = set()
+        # Roster the names were last taken from
+        self.roster: Optional[list[User]] = None
+
+    def add(self, bill_id: int, bill: Bill):
+        self.remove(bill_id)
+        terms = set(re.findall(r"\w+", bill.name.lower()))
+        user_ids = {bill.payer, *bill.participants}
+        self.bill_keys[bill_id] = (terms, user_ids)
+        for term in terms:
+            self.bill_ids[term].add(bill_id)
+        for user_id in user_ids:
+            self.user_bill_ids[user_id].add(bill_id)
+        self.unnamed.update(user_ids - self.names.keys())
+
+    def remove(self, bill_id: int):
+        terms, user_ids = self.bill_keys.pop(bill_id, ((), ()))
+        for postings, keys in ((self.bill_ids, terms), (self.user_bill_ids, user_ids)):
+            for key in keys:
+                postings[key].discard(bill_id)
+                if not postings[key]:
+                    del postings[key]
+
+    def set_name(self, user: User):
+        cached = self.names.get(user.id)
+        if cached is not None:
+            if cached[0] is user:
+                return
+            for term in cached[1]:
+                self.user_ids[term].discard(user.id)
+                if not self.user_ids[term]:
+                    del self.user_ids[term]
+        terms = get_name_terms(user)
+        self.names[user.id] = (user, terms)
+        for term in terms:
+            self.user_ids[term].add(user.id)
+        self.unnamed.discard(user.id)
+
+    def search(self, terms: set[str]) -> set[int]:
+        matches = sorted((self.bill_ids.get(term, set()).union(*(self.user_bill_ids.get(user_id, ())
+                                                                  for user_id in self.user_ids.get(term, ())))
+                          for term in terms), key=len)
+        return matches[0].intersection(*matches[1:])
+
+
+# Bill index of each chat, built on the first /find and kept up to date as bills change. A chat reloaded from the
+# database has a new bills dict and is reindexed.
+bill_indexes: dict[int, BillIndex] = {}
+
+# Latest edit_message_text kwargs waiting to be sent for each (chat_id, message_id)
+pending_edits: dict[tuple[int, int], dict] = {}
+pending_edits_lock = threading.Lock()
+
 
 def get_delete_payment_markup(payment_id: int):
     delete_keyboard = [
@@ -67,6 +300,97 @@ def get_bill_markup(bill_id: int, equal_split: bool = True):
     return markup
 
 
+def get_roster(update: Update, context: CallbackContext) -> list[User]:
+    chat_id = update.effective_chat.id
+    registered = context.chat_data["registered"]
+    roster = rosters.get(chat_id)
+    if roster is not None and update.effective_user is not None:
+        cached = roster[2].get(update.effective_user.id)
+        if cached is not None and (cached.full_name, cached.username) != (update.effective_user.full_name,
+                                                                          update.effective_user.username):
+            # The user has been renamed since the roster was built
+            roster = None
+    if roster is None or roster[0] is not registered:
+        users = sorted((update.effective_chat.get_member(user_id).user for user_id in registered),
+                       key=lambda user: user.full_name)
+        roster = (registered, users, {user.id: user for user in users})
+        rosters[chat_id] = roster
+    return roster[1]
+
+
+def get_user(update: Update, context: CallbackContext, user_id: int) -> User:
+    get_roster(update, context)
+    user = rosters[update.effective_chat.id][2].get(user_id)
+    if user is None:
+        user = update.effective_chat.get_member(user_id).user
+    return user
+
+
+def invalidate_roster(chat_id: int):
+    rosters.pop(chat_id, None)
+
+
+def edit_message_debounced(bot: Bot, chat_id: int, message_id: int, **kwargs):
+    key = (chat_id, message_id)
+    if isinstance(bot, TrackingBot):
+        bot.note_edit(chat_id, message_id)
+    with pending_edits_lock:
+        timer_running = key in pending_edits
+        pending_edits[key] = kwargs
+    if not timer_running:
+        threading.Timer(EDIT_DEBOUNCE_SECONDS, flush_pending_edit, args=(bot, key)).start()
+
+
+def flush_pending_edit(bot: Bot, key: tuple[int, int]):
+    with pending_edits_lock:
+        kwargs = pending_edits.pop(key, None)
+    if kwargs is None:
+        # Superseded by an immediate edit to the same message
+        return
+    chat_id, message_id = key
+    try:
+        bot.edit_message_text(chat_id=chat_id, message_id=message_id, **kwargs)
+    except RetryAfter as e:
+        with pending_edits_lock:
+            if key in pending_edits:
+                return
+            pending_edits[key] = kwargs
+        threading.Timer(e.retry_after, flush_pending_edit, args=(bot, key)).start()
+    except BadRequest as e:
+        if "not modified" not in e.message:
+            logging.log(logging.WARNING, f"Debounced edit failed (chat_id: {chat_id}, message_id: {message_id}): {e}")
+    except TelegramError as e:
+        # Timer threads have no error handler, so anything else such as TimedOut is logged here
+        logging.log(logging.WARNING, f"Debounced edit failed (chat_id: {chat_id}, message_id: {message_id}): {e}")
+
+
+def drop_pending_edit(chat_id: int, message_id: int):
+    with pending_edits_lock:
+        pending_edits.pop((chat_id, message_id), None)
+
+
+def cancel_pending_edit(update: Update, context: CallbackContext):
+    message = update.callback_query.message
+    if message is not None:
+        drop_pending_edit(message.chat_id, message.message_id)
+
+
+def get_roster_markup(users: list[User], page: int, get_button, page_data: str, back_data: str):
+    num_pages = max(1, math.ceil(len(users) / ROSTER_PAGE_SIZE))
+    page = min(max(page, 0), num_pages - 1)
+    start = page * ROSTER_PAGE_SIZE
+    buttons = [get_button(user, page) for user in users[start:start + ROSTER_PAGE_SIZE]]
+    keyboard = [buttons[i:i + ROSTER_COLUMNS] for i in range(0, len(buttons), ROSTER_COLUMNS)]
+    navigation = [InlineKeyboardButton("⬅", callback_data=back_data)]
+    if page > 0:
+        navigation.insert(0, InlineKeyboardButton(f"◀ {page}/{num_pages}", callback_data=page_data + str(page - 1)))
+    if page < num_pages - 1:
+        navigation.append(InlineKeyboardButton(f"{page + 2}/{num_pages} ▶", callback_data=page_data + str(page + 1)))
+    keyboard.append(navigation)
+    markup = InlineKeyboardMarkup(keyboard)
+    return markup
+
+
 MESSAGE_REGISTERING = ("<b>Register To Start Using Bob The Biller</b>\n\nHello, I'm Bob The Biller! "
                        "To start splitting bills and tracking expenses, everyone in the chat will need to "
                        "register by clicking on the button below. For help, please see /help")
@@ -79,13 +403,9 @@ def init(update: Update, context: CallbackContext):
     context.chat_data["payments"] = {}
     context.chat_data["bills"] = {}
     context.chat_data["debts"] = {}
-    context.chat_data["active_manual_split"] = {
-        "active": False,
-        "bill_id": None,
-        "message_id": None,
-        "remaining_participants": [],
-        "current_participant": None
-    }
+    context.chat_data["manual_splits"] = {}
+    context.chat_data["manual_split_prompts"] = {}
+    context.chat_data["stats"] = {}
 
     context.bot.send_message(chat_id=update.effective_chat.id,
                              text=MESSAGE_REGISTERING,
@@ -108,10 +428,19 @@ def help_handler(update: Update, context: CallbackContext):
                                    "E.g.: /bill 23 Taxi @username @username\n\n"
                                    "To split with everyone:\n"
                                    "E.g. : /bill 23 Taxi @all\n\n"
+                                   "<b>/split - Split a bill manually</b>\n"
+                                   "<code>/split [bill] [username or name] [amount] ...</code>\n"
+                                   "E.g.: /split 3 @username 12 Full Name 8.50\n\n"
                                    "<b>/paid - Record a payment to/from someone else</b>\n"
                                    "<code>/paid [amount] [username]</code>\n"
                                    "E.g.: /paid 24.50 @username\n\n"
-                                   "<b>/list - See list of outstanding debts</b>"))
+                                   "<b>/list - See list of outstanding debts</b>\n\n"
+                                   "<b>/find - Search for a bill</b>\n"
+                                   "<code>/find [search terms]</code>\n"
+                                   "E.g.: /find taxi @username\n\n"
+                                   "<b>/stats - See who paid and consumed what</b>\n"
+                                   "<code>/stats [month, year or all]</code>\n"
+                                   "E.g.: /stats 2021-10"))
 
 
 def button_register(update: Update, context: CallbackContext):
@@ -120,6 +449,7 @@ def button_register(update: Update, context: CallbackContext):
         query.answer(text="You've already registered")
     else:
         context.chat_data["registered"].append(query.from_user.id)
+        invalidate_roster(update.effective_chat.id)
         existing_users = list(context.chat_data["debts"].keys())
         context.chat_data["debts"][query.from_user.id] = {_id: 0 for _id in existing_users}
         context.chat_data["debts"][query.from_user.id][None] = 0
@@ -155,6 +485,7 @@ def new_member(update: Update, context: CallbackContext):
             logging.log(logging.INFO, f"Added to chat {update.effective_chat.id}")
         else:
             context.chat_data["registered"].append(user.id)
+            invalidate_roster(update.effective_chat.id)
             existing_users = list(context.chat_data["debts"].keys())
             context.chat_data["debts"][user.id] = {_id: 0 for _id in existing_users}
             context.chat_data["debts"][user.id][None] = 0
@@ -175,10 +506,18 @@ def left_member(update: Update, context: CallbackContext):
             context.chat_data["registered"].remove(user.id)
         except ValueError:
             pass
+        invalidate_roster(update.effective_chat.id)
         logging.log(logging.INFO, f"Left member (chat_id: {update.effective_chat.id}, user_id {user.id}, "
                                   f"name: {user.full_name}, username: {user.username})")
 
 
+class ReplyToBotFilter(MessageFilter):
+    # Replies to anyone but the bot can never answer a manual split prompt, so skip them before any chat data is read
+    def filter(self, message):
+        user = message.reply_to_message.from_user
+        return user is not None and user.id == message.bot.id
+
+
 def add_bill(update: Update, context: CallbackContext):
     try:
         amt_string, name, *list_of_users = context.args
@@ -243,69 +582,72 @@ def add_bill(update: Update, context: CallbackContext):
             context.chat_data["debts"][sender.id][user_id] -= _amt
             context.chat_data["debts"][user_id][sender.id] += _amt
 
-    context.chat_data["bills"][new_id] = {
-        "name": name, "amt": amt, "payer": sender.id, "participants": participant_ids,
-        "datetime": update.message.date, "equal": True, "unclaimed": 0
-    }
+    bill = context.chat_data["bills"][new_id] = Bill(name, amt, sender.id, participant_ids, update.message.date)
     participants: list[tuple[User, float]] = [(update.effective_chat.get_member(user_id).user, amt)
                                               for user_id, amt in participant_ids.items()]
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             parse_mode=ParseMode.HTML,
-                             reply_markup=get_bill_markup(new_id),
-                             text=get_bill_message(name, amt, sender, participants))
+    message = context.bot.send_message(chat_id=update.effective_chat.id,
+                                       parse_mode=ParseMode.HTML,
+                                       reply_markup=get_bill_markup(new_id),
+                                       text=get_bill_message(new_id, name, amt, sender, participants))
+    bill.message_id = message.message_id
+    update_stats(context, bill, 1)
+    index_bill(update, context, new_id)
 
 
-def button_bill_modify_participants(update: Update, context: CallbackContext, bill_id=None):
+def button_bill_modify_participants(update: Update, context: CallbackContext):
     query = update.callback_query
-    if bill_id is None:
-        bill_id = get_bill_id(query)
-        query.answer()
-    bill = context.chat_data["bills"][bill_id]
-    users = sorted((update.effective_chat.get_member(user_id).user for user_id in context.chat_data["registered"]),
-                   key=lambda user: user.full_name)
-    keyboard = [
-                   [InlineKeyboardButton(
-                       f"✅ {user.full_name}" if user.id in bill["participants"] else user.full_name,
-                       callback_data=DATA_MODIFY_PARTICIPANTS_SELECTED + str(bill_id) + "," + str(user.id)
-                   )]
-                   for user in users
-               ] + [[InlineKeyboardButton("⬅", callback_data=DATA_BILL_REDISPLAY + str(bill_id))]]
-    markup = InlineKeyboardMarkup(keyboard)
-    query.edit_message_text(text=f"<b>Who split the bill for <i>{bill['name']}</i>?</b>",
-                            reply_markup=markup,
-                            parse_mode=ParseMode.HTML)
+    bill_id, page = get_bill_id_and_page(query)
+    query.answer()
+    query.edit_message_text(**get_participants_message(update, context, bill_id, page))
+
+
+def get_participants_message(update: Update, context: CallbackContext, bill_id: int, page: int):
+    bill = get_bill(context, bill_id)
+    markup = get_roster_markup(
+        get_roster(update, context), page,
+        lambda user, _page: InlineKeyboardButton(
+            f"✅ {user.full_name}" if user.id in bill.participants else user.full_name,
+            callback_data=DATA_MODIFY_PARTICIPANTS_SELECTED + f"{bill_id},{user.id},{_page}"
+        ),
+        page_data=DATA_MODIFY_PARTICIPANTS + f"{bill_id},",
+        back_data=DATA_BILL_REDISPLAY + str(bill_id))
+    return dict(text=f"<b>Who split the bill for <i>{bill.name}</i>?</b>",
+                reply_markup=markup,
+                parse_mode=ParseMode.HTML)
 
 
 def button_bill_modify_participants_selected(update: Update, context: CallbackContext):
     query = update.callback_query
-    bill_id, user_id = (int(arg) for arg in query.data[2:].split(","))
-    user = update.effective_chat.get_member(user_id).user
-    payer_id = context.chat_data["bills"][bill_id]["payer"]
-    if user_id in context.chat_data["bills"][bill_id]["participants"]:
+    bill_id, user_id, *page = (int(arg) for arg in query.data[2:].split(","))
+    user = get_user(update, context, user_id)
+    bill = get_bill(context, bill_id)
+    update_stats(context, bill, -1)
+    payer_id = bill.payer
+    if user_id in bill.participants:
         # Remove from participants
-        unclaimed = context.chat_data["bills"][bill_id]["participants"][user_id]
-        del context.chat_data["bills"][bill_id]["participants"][user_id]
+        unclaimed = bill.participants[user_id]
+        del bill.participants[user_id]
         if payer_id != user_id:
             context.chat_data["debts"][payer_id][user_id] += unclaimed
             context.chat_data["debts"][user_id][payer_id] -= unclaimed
-        if context.chat_data["bills"][bill_id]["equal"]:
+        if bill.equal:
             redistribute_amounts(context, bill_id)
             query.answer(f"{user.full_name} removed from bill")
         else:
-            context.chat_data["bills"][bill_id]["unclaimed"] += unclaimed
+            bill.unclaimed += unclaimed
             context.chat_data["debts"][payer_id][None] -= unclaimed
             query.answer(f"{user.full_name} removed from bill, ${fmt_amt(unclaimed)} added to unclaimed amount")
     else:
         # Add to participants
-        if context.chat_data["bills"][bill_id]["equal"]:
-            context.chat_data["bills"][bill_id]["participants"][user_id] = 0
+        if bill.equal:
+            bill.participants[user_id] = 0
             redistribute_amounts(context, bill_id)
             query.answer(f"{user.full_name} added to bill")
         else:
-            unclaimed = context.chat_data["bills"][bill_id]["unclaimed"]
+            unclaimed = bill.unclaimed
             if unclaimed > 0:
-                context.chat_data["bills"][bill_id]["participants"][user_id] = unclaimed
-                context.chat_data["bills"][bill_id]["unclaimed"] = 0
+                bill.participants[user_id] = unclaimed
+                bill.unclaimed = 0
                 if payer_id != user_id:
                     context.chat_data["debts"][payer_id][user_id] -= unclaimed
                     context.chat_data["debts"][user_id][payer_id] += unclaimed
@@ -313,36 +655,41 @@ def button_bill_modify_participants_selected(update: Update, context: CallbackCo
                 query.answer(f"{user.full_name} added to bill, took on unclaimed amount of {unclaimed}")
             else:
                 query.answer(f"{user.full_name} added to bill, with $0 on their tab")
-    button_bill_modify_participants(update, context, bill_id)
+    update_stats(context, bill, 1)
+    index_bill(update, context, bill_id)
+    # Answered above straight away; the picker itself is re-rendered once the taps settle down
+    edit_message_debounced(context.bot, query.message.chat_id, query.message.message_id,
+                           **get_participants_message(update, context, bill_id, page[0] if page else 0))
 
 
 def redistribute_amounts(context: CallbackContext, bill_id: int):
-    num_participants = len(context.chat_data["bills"][bill_id]["participants"])
+    bill = get_bill(context, bill_id)
+    num_participants = len(bill.participants)
     if num_participants == 0:
         return
-    payer_id = context.chat_data["bills"][bill_id]["payer"]
-    avg = context.chat_data["bills"][bill_id]["amt"] / num_participants
-    for _id in context.chat_data["bills"][bill_id]["participants"]:
-        old_amt = context.chat_data["bills"][bill_id]["participants"][_id]
-        context.chat_data["bills"][bill_id]["participants"][_id] = avg
+    payer_id = bill.payer
+    avg = bill.amt / num_participants
+    for _id in bill.participants:
+        old_amt = bill.participants[_id]
+        bill.participants[_id] = avg
         if payer_id != _id:
             context.chat_data["debts"][payer_id][_id] -= avg - old_amt
             context.chat_data["debts"][_id][payer_id] += avg - old_amt
 
 
-# TODO: SLOW
 def button_bill_change_payer(update: Update, context: CallbackContext):
     query = update.callback_query
-    bill_id = get_bill_id(query)
+    bill_id, page = get_bill_id_and_page(query)
     query.answer()
-    users = sorted((update.effective_chat.get_member(user_id).user for user_id in context.chat_data["registered"]),
-                   key=lambda user: user.full_name)
-    keyboard = [
-                   [InlineKeyboardButton(user.full_name,
-                                         callback_data=DATA_CHANGE_PAYER_SELECTED + str(bill_id) + "," + str(user.id))]
-                   for user in users if context.chat_data["bills"][bill_id]["payer"] != user.id
-               ] + [[InlineKeyboardButton("⬅", callback_data=DATA_BILL_REDISPLAY + str(bill_id))]]
-    markup = InlineKeyboardMarkup(keyboard)
+    payer_id = get_bill(context, bill_id).payer
+    markup = get_roster_markup(
+        get_roster(update, context), page,
+        lambda user, _page: InlineKeyboardButton(
+            f"🤑 {user.full_name}" if user.id == payer_id else user.full_name,
+            callback_data=DATA_CHANGE_PAYER_SELECTED + f"{bill_id},{user.id}"
+        ),
+        page_data=DATA_CHANGE_PAYER + f"{bill_id},",
+        back_data=DATA_BILL_REDISPLAY + str(bill_id))
     query.edit_message_text(text="<b>Please choose the correct payer:</b>",
                             reply_markup=markup,
                             parse_mode=ParseMode.HTML)
@@ -351,95 +698,206 @@ def button_bill_change_payer(update: Update, context: CallbackContext):
 def button_bill_choose_payer(update: Update, context: CallbackContext):
     query = update.callback_query
     bill_id, payer_id = (int(arg) for arg in query.data[2:].split(","))
-    payer = update.effective_chat.get_member(payer_id).user
-    old_payer_id = context.chat_data["bills"][bill_id]["payer"]
-    context.chat_data["bills"][bill_id]["payer"] = payer.id
+    payer = get_user(update, context, payer_id)
+    bill = get_bill(context, bill_id)
+    update_stats(context, bill, -1)
+    old_payer_id = bill.payer
+    bill.payer = payer.id
 
-    for user_id, amt in context.chat_data["bills"][bill_id]["participants"].items():
+    for user_id, amt in bill.participants.items():
         if old_payer_id != user_id:
             context.chat_data["debts"][old_payer_id][user_id] += amt
             context.chat_data["debts"][user_id][old_payer_id] -= amt
         if payer.id != user_id:
             context.chat_data["debts"][payer.id][user_id] -= amt
             context.chat_data["debts"][user_id][payer.id] += amt
+    update_stats(context, bill, 1)
 
     name, amt, payer, participant_ids, participants, date = get_bill_details(update, context, bill_id)
+    index_bill(update, context, bill_id)
     query.answer(f"Payer changed to {payer.full_name}")
-    query.edit_message_text(text=get_bill_message(name, amt, payer, participants),
-                            reply_markup=get_bill_markup(bill_id, context.chat_data["bills"][bill_id]["equal"]),
+    query.edit_message_text(text=get_bill_message(bill_id, name, amt, payer, participants),
+                            reply_markup=get_bill_markup(bill_id, bill.equal),
                             parse_mode=ParseMode.HTML)
 
 
 def button_bill_split_manually(update: Update, context: CallbackContext):
     query = update.callback_query
     bill_id = get_bill_id(query)
-    name, amt, payer, participant_ids, participants, date = get_bill_details(update, context, bill_id)
-    if not participants:
-        query.answer("Cannot split as there is no one on this bill")
-    else:
-        query.answer("Please follow the instructions carefully to split the bill manually.")
-    context.chat_data["bills"][bill_id]["equal"] = False
-    context.chat_data["active_manual_split"] = {
-        "active": True,
-        "bill_id": bill_id,
-        "message_id": query.message.message_id,
-        "remaining_participants": [user.id for user, _ in
-                                   sorted(participants, key=lambda user: user[0].full_name, reverse=True)],
-        "current_participant": None
-    }
-    user_id = context.chat_data["active_manual_split"]["remaining_participants"].pop()
-    context.chat_data["active_manual_split"]["current_participant"] = user_id
-    user = update.effective_chat.get_member(user_id).user
+    query.answer("Please reply with everyone's share to split the bill manually.")
+    bill = get_bill(context, bill_id)
+    bill.message_id = query.message.message_id
+    participants = ((get_user(update, context, user_id), amt) for user_id, amt in bill.participants.items())
+    example = " ".join(f"@{user.username} {fmt_amt(amt)}" if user.username else f"{user.full_name} {fmt_amt(amt)}"
+                       for user, amt in participants)
     query.edit_message_text(text=query.message.text_html, parse_mode=ParseMode.HTML)
-    query.message.reply_text(reply_markup=ForceReply(selective=True, input_field_placeholder="amount"),
-                             text=f"@{query.from_user.username}, how much should {user.full_name} pay for this bill?")
+    prompt = query.message.reply_text(
+        reply_markup=ForceReply(selective=True, input_field_placeholder="@username amount @username amount"),
+        text=f"@{query.from_user.username}, how much should each person pay for this bill "
+             f"(${fmt_amt(bill.amt)} in total)? Reply with everyone's share in one message, naming people by "
+             f"@username or, if they have none, by full name, e.g.:\n{example}")
+    start_manual_split(context, bill_id, query.message.message_id, prompt.message_id)
+
+
+def start_manual_split(context: CallbackContext, bill_id: int, message_id: int, prompt_id: int):
+    # Sessions are keyed by the bill's message, so several bills can be split at the same time
+    context.chat_data.setdefault("manual_splits", {})[message_id] = bill_id
+    context.chat_data.setdefault("manual_split_prompts", {})[prompt_id] = message_id
+
+
+def end_manual_split(context: CallbackContext, message_id: int):
+    context.chat_data["manual_splits"].pop(message_id, None)
+    for prompt_id, _message_id in list(context.chat_data["manual_split_prompts"].items()):
+        if _message_id == message_id:
+            del context.chat_data["manual_split_prompts"][prompt_id]
 
 
 def split_manually(update: Update, context: CallbackContext):
-    if context.chat_data["active_manual_split"]["active"]:
-        prev_user_id = context.chat_data["active_manual_split"]["current_participant"]
+    prompt_id = update.message.reply_to_message.message_id
+    message_id = context.chat_data.get("manual_split_prompts", {}).get(prompt_id)
+    if message_id is None:
+        return
+    bill_id = context.chat_data["manual_splits"][message_id]
+    if bill_id not in context.chat_data["bills"]:
+        end_manual_split(context, message_id)
+        update.message.reply_text(text="This bill has been deleted.")
+        return
+    try:
+        amounts = parse_manual_split(update, context, bill_id, update.message.text.split())
+    except ValueError as e:
+        prompt = update.message.reply_text(
+            reply_markup=ForceReply(selective=True, input_field_placeholder="@username amount @username amount"),
+            text=f"{e}. Please try again.")
+        context.chat_data["manual_split_prompts"][prompt.message_id] = message_id
+        return
+    apply_manual_split(context, bill_id, amounts)
+    index_bill(update, context, bill_id)
+    end_manual_split(context, message_id)
+    redisplay_bill(update, context, bill_id)
+    update.message.reply_text(text=f"All done!")
+
+
+def split_command(update: Update, context: CallbackContext):
+    try:
+        bill_id = int(context.args[0].lstrip("#"))
+    except (IndexError, ValueError):
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Invalid format. Please type /split [bill] [username or name] [amount] ...")
+        return
+    if bill_id not in context.chat_data["bills"]:
+        context.bot.send_message(chat_id=update.effective_chat.id, text=f"Unrecognised bill: #{bill_id}")
+        return
+    try:
+        amounts = parse_manual_split(update, context, bill_id, context.args[1:])
+    except ValueError as e:
+        context.bot.send_message(chat_id=update.effective_chat.id, text=f"{e}.")
+        return
+    apply_manual_split(context, bill_id, amounts)
+    index_bill(update, context, bill_id)
+    message_id = get_bill(context, bill_id).message_id
+    if message_id in context.chat_data.get("manual_splits", {}):
+        end_manual_split(context, message_id)
+    redisplay_bill(update, context, bill_id)
+
+
+def parse_manual_split(update: Update, context: CallbackContext, bill_id: int, args: list[str]):
+    # Each person is named by @username or, for those without one, by their full name, followed by their amount
+    bill = get_bill(context, bill_id)
+    users = {user.id: user for user in get_roster(update, context)}
+    users.update((user_id, get_user(update, context, user_id)) for user_id in bill.participants)
+    user_ids = {f"@{user.username.lower()}": [user.id] for user in users.values() if user.username}
+    for user in users.values():
+        user_ids.setdefault(user.full_name.lower(), []).append(user.id)
+    amounts: dict[int, float] = {}
+    name_parts = []
+    for arg in args:
         try:
-            amt = float(update.message.text)
+            amt = float(arg)
         except ValueError:
-            update.message.reply_text(reply_markup=ForceReply(selective=True, input_field_placeholder="amount"),
-                                      text=f"Invalid amount, please try again.")
-            return
-        bill_id = context.chat_data["active_manual_split"]["bill_id"]
-        payer_id = context.chat_data["bills"][bill_id]["payer"]
-        old_amt = context.chat_data["bills"][bill_id]["participants"][prev_user_id]
-        context.chat_data["bills"][bill_id]["participants"][prev_user_id] = amt
-        if payer_id != prev_user_id:
-            context.chat_data["debts"][payer_id][prev_user_id] -= amt - old_amt
-            context.chat_data["debts"][prev_user_id][payer_id] += amt - old_amt
-        name, amt, payer, participant_ids, participants, date = get_bill_details(update, context, bill_id)
+            name_parts.append(arg)
+            continue
+        if not name_parts:
+            raise ValueError(f"Please name the person who should pay {arg}, e.g. @username 12.50 or Full Name 12.50")
+        name = " ".join(name_parts)
+        name_parts = []
+        matches = user_ids.get(name.lower(), [])
+        if not matches:
+            raise ValueError(f"Unrecognised person: {name}")
+        if len(matches) > 1:
+            raise ValueError(f"More than one person is called {name}, please use their @username")
+        if matches[0] in amounts:
+            raise ValueError(f"{name} is listed more than once")
+        if not math.isfinite(amt) or amt < 0 or -decimal.Decimal(arg).as_tuple().exponent > 2:
+            raise ValueError(f"Invalid amount for {name}: {arg}")
+        amounts[matches[0]] = amt
+    if name_parts:
+        raise ValueError(f"No amount given for {' '.join(name_parts)}")
+    if not amounts:
+        raise ValueError("Invalid format, please list each person followed by their amount, e.g. @username 12.50")
+    total = sum(amounts.values())
+    if abs(total - bill.amt) >= 0.01:
+        raise ValueError(f"The amounts add up to ${fmt_amt(total)}, but the bill is ${fmt_amt(bill.amt)}")
+    # Checked up front, so that apply_manual_split never leaves the ledger half-updated
+    debts = context.chat_data["debts"]
+    for user_id in amounts.keys() | bill.participants.keys():
+        if user_id != bill.payer and (user_id not in debts.get(bill.payer, {})
+                                      or bill.payer not in debts.get(user_id, {})):
+            raise ValueError(f"Cannot split this bill, {get_user(update, context, user_id).full_name} "
+                             f"has no balance with the payer")
+    if bill.unclaimed and None not in debts.get(bill.payer, {}):
+        raise ValueError("Cannot split this bill, its unclaimed amount is missing from the payer's balance")
+    return amounts
+
+
+def apply_manual_split(context: CallbackContext, bill_id: int, amounts: dict[int, float]):
+    bill = get_bill(context, bill_id)
+    payer_id = bill.payer
+    changes = {user_id: amounts.get(user_id, 0) - bill.participants.get(user_id, 0)
+               for user_id in amounts.keys() | bill.participants.keys() if user_id != payer_id}
+    update_stats(context, bill, -1)
+    for user_id, change in changes.items():
+        context.chat_data["debts"][payer_id][user_id] -= change
+        context.chat_data["debts"][user_id][payer_id] += change
+    if bill.unclaimed:
+        context.chat_data["debts"][payer_id][None] += bill.unclaimed
+    bill.participants = amounts
+    bill.unclaimed = 0
+    bill.equal = False
+    update_stats(context, bill, 1)
+
+
+def redisplay_bill(update: Update, context: CallbackContext, bill_id: int):
+    name, amt, payer, participant_ids, participants, date = get_bill_details(update, context, bill_id)
+    bill = get_bill(context, bill_id)
+    if bill.message_id is None:
+        # Bills created before message ids were recorded are shown again in a new message
+        message = context.bot.send_message(chat_id=update.effective_chat.id,
+                                           parse_mode=ParseMode.HTML,
+                                           reply_markup=get_bill_markup(bill_id, False),
+                                           text=get_bill_message(bill_id, name, amt, payer, participants))
+        bill.message_id = message.message_id
+    else:
+        # The bill message may still be showing the participant picker, whose pending edit would overwrite this one
+        drop_pending_edit(update.effective_chat.id, bill.message_id)
         context.bot.edit_message_text(chat_id=update.effective_chat.id,
-                                      message_id=context.chat_data["active_manual_split"]["message_id"],
+                                      message_id=bill.message_id,
                                       parse_mode=ParseMode.HTML,
-                                      reply_markup=get_bill_markup(bill_id,
-                                                                   context.chat_data["bills"][bill_id]["equal"]) if not
-                                      context.chat_data["active_manual_split"]["remaining_participants"] else None,
-                                      text=get_bill_message(name, amt, payer, participants))
-
-        if not context.chat_data["active_manual_split"]["remaining_participants"]:
-            context.chat_data["active_manual_split"]["active"] = False
-            update.message.reply_text(text=f"All done!")
-        else:
-            user_id = context.chat_data["active_manual_split"]["remaining_participants"].pop()
-            context.chat_data["active_manual_split"]["current_participant"] = user_id
-            user = update.effective_chat.get_member(user_id).user
-            update.message.reply_text(reply_markup=ForceReply(selective=True, input_field_placeholder="amount"),
-                                      text=f"@{update.message.from_user.username}, how much should {user.full_name} pay?")
+                                      reply_markup=get_bill_markup(bill_id, False),
+                                      text=get_bill_message(bill_id, name, amt, payer, participants))
 
 
 def button_bill_split_equally(update: Update, context: CallbackContext):
     query = update.callback_query
     bill_id = get_bill_id(query)
+    bill = get_bill(context, bill_id)
+    update_stats(context, bill, -1)
     redistribute_amounts(context, bill_id)
-    context.chat_data["bills"][bill_id]["equal"] = True
+    bill.equal = True
+    update_stats(context, bill, 1)
     name, amt, payer, participant_ids, participants, date = get_bill_details(update, context, bill_id)
     query.answer("Bill changed to split equally")
-    query.edit_message_text(text=get_bill_message(name, amt, payer, participants),
-                            reply_markup=get_bill_markup(bill_id, context.chat_data["bills"][bill_id]["equal"]),
+    query.edit_message_text(text=get_bill_message(bill_id, name, amt, payer, participants),
+                            reply_markup=get_bill_markup(bill_id, bill.equal),
                             parse_mode=ParseMode.HTML)
 
 
@@ -464,8 +922,10 @@ def button_bill_delete_confirm(update: Update, context: CallbackContext):
     bill_id = get_bill_id(query)
     query.answer()
     name, amt, payer, participant_ids, participants, date = get_bill_details(update, context, bill_id)
+    update_stats(context, get_bill(context, bill_id), -1)
     del context.chat_data["bills"][bill_id]
-    query.edit_message_text(text=f"<s>{get_bill_message(name, amt, payer, participants)}</s>\n\n"
+    unindex_bill(update, context, bill_id)
+    query.edit_message_text(text=f"<s>{get_bill_message(bill_id, name, amt, payer, participants)}</s>\n\n"
                                  f"Deleted by {query.from_user.full_name} on {query.message.date}",
                             parse_mode=ParseMode.HTML)
 
@@ -475,31 +935,197 @@ def button_bill_redisplay(update: Update, context: CallbackContext):
     bill_id = get_bill_id(query)
     query.answer()
     name, amt, payer, participant_ids, participants, date = get_bill_details(update, context, bill_id)
-    query.edit_message_text(text=get_bill_message(name, amt, payer, participants),
-                            reply_markup=get_bill_markup(bill_id, context.chat_data["bills"][bill_id]["equal"]),
+    query.edit_message_text(text=get_bill_message(bill_id, name, amt, payer, participants),
+                            reply_markup=get_bill_markup(bill_id, get_bill(context, bill_id).equal),
                             parse_mode=ParseMode.HTML)
 
 
+def get_bill(context: CallbackContext, bill_id: int) -> Bill:
+    return context.chat_data["bills"][bill_id]
+
+
+def get_name_terms(user: User) -> set[str]:
+    return set(re.findall(r"\w+", f"{user.full_name} {user.username or ''}".lower()))
+
+
+def get_bill_index(update: Update, context: CallbackContext) -> BillIndex:
+    bills = context.chat_data["bills"]
+    index = bill_indexes.get(update.effective_chat.id)
+    if index is None or index.bills is not bills:
+        index = BillIndex(bills)
+        bill_indexes[update.effective_chat.id] = index
+        for bill_id, bill in bills.items():
+            index.add(bill_id, bill)
+    update_indexed_names(update, context, index)
+    return index
+
+
+def update_indexed_names(update: Update, context: CallbackContext, index: BillIndex):
+    # The roster is rebuilt when someone joins, leaves, registers or is renamed, so names are only taken again then
+    roster = get_roster(update, context)
+    if index.roster is not roster:
+        index.roster = roster
+        for user in roster:
+            index.set_name(user)
+    user = update.effective_user
+    if user is not None and user.id in index.names:
+        cached = index.names[user.id][0]
+        if (cached.full_name, cached.username) != (user.full_name, user.username):
+            # Also covers people who are no longer registered
+            index.set_name(user)
+    for user_id in list(index.unnamed):
+        # Only people who are no longer registered are looked up with get_member, once
+        index.set_name(get_user(update, context, user_id))
+
+
+def index_bill(update: Update, context: CallbackContext, bill_id: int):
+    index = bill_indexes.get(update.effective_chat.id)
+    if index is None or index.bills is not context.chat_data["bills"]:
+        # Not searched yet, so it will be indexed along with the other bills on the first /find
+        return
+    index.add(bill_id, get_bill(context, bill_id))
+
+
+def unindex_bill(update: Update, context: CallbackContext, bill_id: int):
+    index = bill_indexes.get(update.effective_chat.id)
+    if index is None or index.bills is not context.chat_data["bills"]:
+        return
+    index.remove(bill_id)
+
+
+def find(update: Update, context: CallbackContext):
+    query = " ".join(context.args)
+    terms = set(re.findall(r"\w+", query.lower()))
+    if not terms:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Invalid format. Please type /find [search terms]")
+        return
+    found = get_bill_index(update, context).search(terms)
+    if not found:
+        context.bot.send_message(chat_id=update.effective_chat.id, text=f"No bills found for {query}")
+        return
+    # Bill ids are handed out in order, so the largest are the most recent
+    keyboard = [
+        [InlineKeyboardButton(f"#{bill_id} {bill.name} ${fmt_amt(bill.amt)} ({bill.datetime:%d %b %Y})",
+                              callback_data=DATA_BILL_REDISPLAY + str(bill_id))]
+        for bill_id, bill in ((bill_id, get_bill(context, bill_id)) for bill_id in heapq.nlargest(FIND_LIMIT, found))
+    ]
+    text = f"<b>Bills matching <i>{html.escape(query)}</i></b>"
+    if len(found) > FIND_LIMIT:
+        text += f"\n\n{len(found)} found, showing the {FIND_LIMIT} most recent"
+    context.bot.send_message(chat_id=update.effective_chat.id,
+                             text=text,
+                             reply_markup=InlineKeyboardMarkup(keyboard),
+                             parse_mode=ParseMode.HTML)
+
+
+def get_month(date: datetime.datetime) -> str:
+    return f"{date:%Y-%m}"
+
+
+def add_amount(totals: dict, key, amt: float):
+    totals[key] = totals.get(key, 0) + amt
+    if abs(totals[key]) < 1e-9:
+        del totals[key]
+
+
+def update_stats(context: CallbackContext, bill: Bill, sign: int):
+    """Adds (sign 1) or removes (sign -1) a bill from the monthly rollups used by /stats."""
+    stats = context.chat_data.get("stats")
+    if stats is None:
+        # Chats from before /stats are backfilled in bulk on their first /stats
+        return
+    month = stats.setdefault(get_month(bill.datetime), MonthStats())
+    add_amount(month.paid, bill.payer, sign * bill.amt)
+    for user_id, amt in bill.participants.items():
+        add_amount(month.consumed, user_id, sign * amt)
+    add_amount(month.categories, bill.name.lower(), sign * bill.amt)
+
+
+def rebuild_stats(context: CallbackContext):
+    paid = collections.defaultdict(collections.Counter)
+    consumed = collections.defaultdict(collections.Counter)
+    categories = collections.defaultdict(collections.Counter)
+    for bill in context.chat_data["bills"].values():
+        month = get_month(bill.datetime)
+        paid[month][bill.payer] += bill.amt
+        consumed[month].update(bill.participants)
+        categories[month][bill.name.lower()] += bill.amt
+    context.chat_data["stats"] = {
+        month: MonthStats(dict(paid[month]), dict(consumed[month]), dict(categories[month]))
+        for month in paid
+    }
+
+
+def stats(update: Update, context: CallbackContext):
+    if "stats" not in context.chat_data:
+        rebuild_stats(context)
+    rollups = context.chat_data["stats"]
+    period = context.args[0].lower() if context.args else get_month(update.message.date)
+    if period == "all":
+        title = "All Time"
+        months = sorted(rollups)
+    elif re.fullmatch(r"\d{4}-(0[1-9]|1[0-2])", period):
+        title = f"{datetime.datetime.strptime(period, '%Y-%m'):%b %Y}"
+        months = [period] if period in rollups else []
+    elif re.fullmatch(r"\d{4}", period):
+        title = period
+        months = sorted(month for month in rollups if month.startswith(period + "-"))
+    else:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Invalid format. Please type /stats [YYYY-MM, YYYY or all]")
+        return
+    paid = collections.Counter()
+    consumed = collections.Counter()
+    for month in months:
+        paid.update(rollups[month].paid)
+        consumed.update(rollups[month].consumed)
+    users = sorted((get_user(update, context, user_id) for user_id in paid.keys() | consumed.keys()),
+                   key=lambda user: user.full_name)
+    if not users:
+        context.bot.send_message(chat_id=update.effective_chat.id, text=f"No bills in {title}")
+        return
+    message = [f"<b><u>Spending: {title}</u></b>\n"]
+    for user in users:
+        message.append(f"<b>{user.full_name}</b>: paid ${fmt_amt(float(paid[user.id]))}, "
+                       f"consumed ${fmt_amt(float(consumed[user.id]))}")
+    message.append("\n<b>Top Categories</b>")
+    for month in months[-STATS_MONTHS:]:
+        top = heapq.nlargest(STATS_TOP_CATEGORIES, rollups[month].categories.items(), key=lambda item: item[1])
+        if not top:
+            continue
+        message.append(f"{datetime.datetime.strptime(month, '%Y-%m'):%b %Y}: "
+                       + ", ".join(f"{category.capitalize()} ${fmt_amt(amt)}" for category, amt in top))
+    context.bot.send_message(chat_id=update.effective_chat.id,
+                             text="\n".join(message),
+                             parse_mode=ParseMode.HTML)
+
+
 def get_bill_id(query):
     return int(query.data[2:])
 
 
+def get_bill_id_and_page(query):
+    bill_id, _, page = query.data[2:].partition(",")
+    return int(bill_id), int(page) if page else 0
+
+
 def get_bill_details(update: Update, context: CallbackContext, bill_id: int):
-    bill = context.chat_data["bills"][bill_id]
-    payer: User = update.effective_chat.get_member(bill["payer"]).user
-    name: str = bill["name"]
-    amt: float = bill["amt"]
-    participant_ids: dict[int, float] = bill["participants"]
+    bill = get_bill(context, bill_id)
+    payer: User = update.effective_chat.get_member(bill.payer).user
+    name: str = bill.name
+    amt: float = bill.amt
+    participant_ids: dict[int, float] = bill.participants
     participants: list[tuple[User, float]] = [(update.effective_chat.get_member(user_id).user, amt)
                                               for user_id, amt in participant_ids.items()]
-    date: datetime.datetime = bill["datetime"]
+    date: datetime.datetime = bill.datetime
     return name, amt, payer, participant_ids, participants, date
 
 
-def get_bill_message(name: str, amt: float, payer: User, participants: list[tuple[User, float]]):
+def get_bill_message(bill_id: int, name: str, amt: float, payer: User, participants: list[tuple[User, float]]):
     participants = sorted(participants, key=lambda user: user[0].full_name)
     participant_list = (f"• {user.full_name} (@{user.username}): ${fmt_amt(amt)}" for user, amt in participants)
-    return (f"<b><u>Split Bill: {name}</u></b>\n"
+    return (f"<b><u>Split Bill #{bill_id}: {name}</u></b>\n"
             f"<b>${fmt_amt(amt)}</b>, paid by <b>{payer.full_name}</b>\n\n"
             + "\n".join(participant_list))
 
@@ -551,9 +1177,7 @@ def paid(update: Update, context: CallbackContext):
 
     balance = context.chat_data["debts"][payer][payee]
 
-    context.chat_data["payments"][new_id] = {
-        "payee": payee, "payer": payer, "amt": amt, "datetime": update.message.date, "balance": balance
-    }
+    context.chat_data["payments"][new_id] = Payment(payee, payer, amt, update.message.date, balance)
 
     payer = update.effective_chat.get_member(payer).user
     payee = update.effective_chat.get_member(payee).user
@@ -620,12 +1244,12 @@ def button_payment_delete_cancel(update: Update, context: CallbackContext):
 def get_payment_details(update: Update, context: CallbackContext):
     query = update.callback_query
     payment_id = int(query.data[2:])
-    payment = context.chat_data["payments"][payment_id]
-    payer: User = update.effective_chat.get_member(payment["payer"]).user
-    payee: User = update.effective_chat.get_member(payment["payee"]).user
-    amt: float = payment["amt"]
-    balance: float = payment["balance"]
-    date: datetime.datetime = payment["datetime"]
+    payment: Payment = context.chat_data["payments"][payment_id]
+    payer: User = update.effective_chat.get_member(payment.payer).user
+    payee: User = update.effective_chat.get_member(payment.payee).user
+    amt: float = payment.amt
+    balance: float = payment.balance
+    date: datetime.datetime = payment.datetime
     return payment_id, payer, payee, amt, balance, date
 
 
@@ -648,8 +1272,7 @@ def fmt_amt(amt):
 
 
 def list_summary(update: Update, context: CallbackContext):
-    users = sorted((update.effective_chat.get_member(user_id).user for user_id in context.chat_data["registered"]),
-                   key=lambda _user: _user.full_name)
+    users = get_roster(update, context)
     all_settled = True
     message = ["<b><u>List of Outstanding Debts</u></b>"]
     for user1 in users:
@@ -686,40 +1309,52 @@ def list_summary(update: Update, context: CallbackContext):
                              parse_mode=ParseMode.HTML)
 
 
-dispatcher.add_handler(MessageHandler(Filters.reply, split_manually))
+def add_handlers(dispatcher: Dispatcher):
+    # Any other button on a message drops its pending debounced edit, so a stale picker can't overwrite the new view
+    dispatcher.add_handler(CallbackQueryHandler(cancel_pending_edit,
+                                                pattern=f"^(?!{DATA_MODIFY_PARTICIPANTS_SELECTED})"), group=-2)
+
+    dispatcher.add_handler(MessageHandler(Filters.update.message & Filters.reply & Filters.text & ~Filters.command
+                                          & ReplyToBotFilter(), split_manually))
+
+    dispatcher.add_handler(MessageHandler(Filters.status_update.new_chat_members, new_member))
+    dispatcher.add_handler(MessageHandler(Filters.status_update.left_chat_member, left_member))
 
-dispatcher.add_handler(MessageHandler(Filters.status_update.new_chat_members, new_member))
-dispatcher.add_handler(MessageHandler(Filters.status_update.left_chat_member, left_member))
+    dispatcher.add_handler(CallbackQueryHandler(button_register, pattern=f"^{DATA_REGISTER}$"))
 
-dispatcher.add_handler(CallbackQueryHandler(button_register, pattern=f"^{DATA_REGISTER}$"))
+    dispatcher.add_handler(CommandHandler('help', help_handler, filters=Filters.update.message))
 
-help_handler = CommandHandler('help', help_handler, filters=Filters.update.message)
-dispatcher.add_handler(help_handler)
+    add_bill_handler = CommandHandler('bill', add_bill, filters=Filters.update.message)
+    dispatcher.add_handler(add_bill_handler)
+    split_handler = CommandHandler('split', split_command, filters=Filters.update.message)
+    dispatcher.add_handler(split_handler)
+    dispatcher.add_handler(CallbackQueryHandler(button_bill_delete, pattern=f"^{DATA_BILL_DELETE}"))
+    dispatcher.add_handler(CallbackQueryHandler(button_bill_delete_confirm, pattern=f"^{DATA_BILL_DELETE_YES}"))
+    dispatcher.add_handler(CallbackQueryHandler(button_bill_redisplay, pattern=f"^{DATA_BILL_REDISPLAY}"))
+    dispatcher.add_handler(CallbackQueryHandler(button_bill_modify_participants,
+                                                pattern=f"^{DATA_MODIFY_PARTICIPANTS}"))
+    dispatcher.add_handler(CallbackQueryHandler(button_bill_modify_participants_selected,
+                                                pattern=f"^{DATA_MODIFY_PARTICIPANTS_SELECTED}"))
+    dispatcher.add_handler(CallbackQueryHandler(button_bill_split_manually, pattern=f"^{DATA_SPLIT_MANUALLY}"))
+    dispatcher.add_handler(CallbackQueryHandler(button_bill_split_equally, pattern=f"^{DATA_SPLIT_EQUALLY}"))
+    dispatcher.add_handler(CallbackQueryHandler(button_bill_change_payer, pattern=f"^{DATA_CHANGE_PAYER}"))
+    dispatcher.add_handler(CallbackQueryHandler(button_bill_choose_payer, pattern=f"^{DATA_CHANGE_PAYER_SELECTED}"))
 
-add_bill_handler = CommandHandler('bill', add_bill, filters=Filters.update.message)
-dispatcher.add_handler(add_bill_handler)
-dispatcher.add_handler(CallbackQueryHandler(button_bill_delete, pattern=f"^{DATA_BILL_DELETE}"))
-dispatcher.add_handler(CallbackQueryHandler(button_bill_delete_confirm, pattern=f"^{DATA_BILL_DELETE_YES}"))
-dispatcher.add_handler(CallbackQueryHandler(button_bill_redisplay, pattern=f"^{DATA_BILL_REDISPLAY}"))
-dispatcher.add_handler(CallbackQueryHandler(button_bill_modify_participants, pattern=f"^{DATA_MODIFY_PARTICIPANTS}"))
-dispatcher.add_handler(CallbackQueryHandler(button_bill_modify_participants_selected,
-                                            pattern=f"^{DATA_MODIFY_PARTICIPANTS_SELECTED}"))
-dispatcher.add_handler(CallbackQueryHandler(button_bill_split_manually, pattern=f"^{DATA_SPLIT_MANUALLY}"))
-dispatcher.add_handler(CallbackQueryHandler(button_bill_split_equally, pattern=f"^{DATA_SPLIT_EQUALLY}"))
-dispatcher.add_handler(CallbackQueryHandler(button_bill_change_payer, pattern=f"^{DATA_CHANGE_PAYER}"))
-dispatcher.add_handler(CallbackQueryHandler(button_bill_choose_payer, pattern=f"^{DATA_CHANGE_PAYER_SELECTED}"))
+    paid_handler = CommandHandler('paid', paid, filters=Filters.update.message)
+    dispatcher.add_handler(paid_handler)
+    dispatcher.add_handler(CallbackQueryHandler(button_payment_delete, pattern=f"^{DATA_PAYMENT_DELETE}"))
+    dispatcher.add_handler(CallbackQueryHandler(button_payment_delete_confirm, pattern=f"^{DATA_PAYMENT_DELETE_YES}"))
+    dispatcher.add_handler(CallbackQueryHandler(button_payment_delete_cancel, pattern=f"^{DATA_PAYMENT_DELETE_NO}"))
 
-paid_handler = CommandHandler('paid', paid, filters=Filters.update.message)
-dispatcher.add_handler(paid_handler)
-dispatcher.add_handler(CallbackQueryHandler(button_payment_delete, pattern=f"^{DATA_PAYMENT_DELETE}"))
-dispatcher.add_handler(CallbackQueryHandler(button_payment_delete_confirm, pattern=f"^{DATA_PAYMENT_DELETE_YES}"))
-dispatcher.add_handler(CallbackQueryHandler(button_payment_delete_cancel, pattern=f"^{DATA_PAYMENT_DELETE_NO}"))
+    list_handler = CommandHandler('list', list_summary, filters=Filters.update.message)
+    dispatcher.add_handler(list_handler)
 
-list_handler = CommandHandler('list', list_summary, filters=Filters.update.message)
-dispatcher.add_handler(list_handler)
+    find_handler = CommandHandler('find', find, filters=Filters.update.message)
+    dispatcher.add_handler(find_handler)
+
+    stats_handler = CommandHandler('stats', stats, filters=Filters.update.message)
+    dispatcher.add_handler(stats_handler)
 
-thread = threading.Thread(target=dispatcher.start, name="dispatcher")
-thread.start()
 
 app = Flask(__name__)
 
@@ -728,7 +1363,18 @@ app = Flask(__name__)
 # https://www.toptal.com/python/telegram-bot-tutorial-python
 @app.route('/{}'.format(TOKEN), methods=['POST'])
 def respond():
-    update = Update.de_json(request.get_json(force=True), bot)
+    data = request.get_json(force=True)
+    if recorder is not None:
+        recorder.record(data)
+    update = Update.de_json(data, bot)
+    # Each chat is handled by the one instance holding its lease. Forwarded updates are never forwarded again.
+    if update.effective_chat is not None:
+        forwarded = FORWARDED_HEADER in request.headers
+        owner_url = None if forwarded else persistence.get_chat_owner(update.effective_chat.id)
+        if owner_url is not None and forward_update(owner_url, data):
+            return 'ok', 200
+        if forwarded or owner_url is not None:
+            local_updates.add(update.update_id)
     update_queue.put(update)
     return 'ok', 200
 
@@ -747,4 +1393,15 @@ def index():
     return '!'
 
 
-app.run(host="0.0.0.0", port=PORT, threaded=True)
+if __name__ == "__main__":
+    persistence = persistence.MongoPersistence()
+    bot = TrackingBot(token=TOKEN)
+    update_queue = queue.Queue()
+    dispatcher = RetryingDispatcher(bot, update_queue, persistence=persistence)
+    add_handlers(dispatcher)
+    recorder = recording.UpdateRecorder.from_env(bot)
+
+    thread = threading.Thread(target=dispatcher.start, name="dispatcher")
+    thread.start()
+
+    app.run(host="0.0.0.0", port=PORT, threaded=True)
@@ -0,0 +1,204 @@
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import secrets
+import signal
+import threading
+import time
+import zlib
+
+from typing import Iterator, Optional
+
+from telegram import Bot
+
+# Set RECORD_UPDATES to a path such as updates.jsonl.gz to record every incoming webhook update. Each process writes
+# its own file, named after the path with the time it started, such as updates-20211019T120000-42.jsonl.gz.
+# RECORD_ANONYMIZE lists what to anonymize ("ids", "names", both by default, or "none").
+# RECORD_SALT keeps pseudonyms stable across restarts; without it they change each time the bot starts.
+# Names in message text are anonymized when they are @mentions, or the full name of a user seen in the recording so far,
+# as /split uses for people without a username. Any other text is recorded as is.
+RECORD_UPDATES = os.environ.get("RECORD_UPDATES")
+RECORD_ANONYMIZE = os.environ.get("RECORD_ANONYMIZE", "ids,names")
+RECORD_SALT = os.environ.get("RECORD_SALT")
+
+CHAT_TYPES = {"private", "group", "supergroup", "channel"}
+NAME_FIELDS = {"first_name", "last_name", "title"}
+# Numbers this large in callback data are user ids rather than bill, payment or page numbers
+MIN_CALLBACK_USER_ID = 10000
+
+# Mentions only, not the bot username in commands such as /bill@BobTheBillerBot
+MENTION_PATTERN = re.compile(r"(?<!\w)@(\w{5,32})")
+CALLBACK_NUMBER_PATTERN = re.compile(r"\d+")
+
+
+class Anonymizer:
+    def __init__(self, salt: bytes, ids: bool = True, names: bool = True):
+        self.salt = salt
+        self.ids = ids
+        self.names = names
+        # Pseudonyms of the full names of users seen so far, by lowercased full name
+        self.full_names: dict[str, str] = {}
+        self.full_name_pattern: Optional[re.Pattern] = None
+
+    def digest(self, value) -> str:
+        return hmac.new(self.salt, str(value).encode(), hashlib.sha256).hexdigest()
+
+    def anonymize_id(self, _id: int) -> int:
+        # Keeps the sign, since group chat ids are negative
+        pseudonym = int(self.digest(abs(_id))[:12], 16) % 10 ** 10 + MIN_CALLBACK_USER_ID
+        return -pseudonym if _id < 0 else pseudonym
+
+    def anonymize_username(self, username: str) -> str:
+        # Same length as the original, so that entity offsets in the message text stay correct
+        return ("u" + self.digest(username.lower()))[:len(username)]
+
+    def anonymize_name(self, _key: str, name: str, _id: int) -> str:
+        # Same length as the original in UTF-16 code units, which entity offsets count in
+        length = len(name.encode("utf-16-le")) // 2
+        return (_key[0].upper() + self.digest(_id) * 2)[:length]
+
+    def anonymize_full_names(self, text: str) -> str:
+        if not self.full_names:
+            return text
+        if self.full_name_pattern is None:
+            names = sorted(self.full_names, key=len, reverse=True)
+            self.full_name_pattern = re.compile(
+                r"(?<!\w)(" + "|".join(re.escape(name) for name in names) + r")(?!\w)", re.IGNORECASE)
+        return self.full_name_pattern.sub(lambda match: self.full_names[match.group().lower()], text)
+
+    def remember_full_names(self, obj):
+        if isinstance(obj, list):
+            for item in obj:
+                self.remember_full_names(item)
+        elif isinstance(obj, dict):
+            if obj.get("is_bot") is False and isinstance(obj.get("first_name"), str):
+                full_name = obj["first_name"]
+                pseudonym = self.anonymize_name("first_name", obj["first_name"], obj.get("id"))
+                if isinstance(obj.get("last_name"), str):
+                    full_name += " " + obj["last_name"]
+                    pseudonym += " " + self.anonymize_name("last_name", obj["last_name"], obj.get("id"))
+                if self.full_names.get(full_name.lower()) != pseudonym:
+                    self.full_names[full_name.lower()] = pseudonym
+                    self.full_name_pattern = None
+            for value in obj.values():
+                self.remember_full_names(value)
+
+    def anonymize_update(self, update: dict) -> dict:
+        if self.names:
+            # Users anywhere in the update first, since the text may come before them
+            self.remember_full_names(update)
+        return self.anonymize(update)
+
+    def anonymize(self, obj):
+        if isinstance(obj, list):
+            return [self.anonymize(item) for item in obj]
+        if not isinstance(obj, dict):
+            return obj
+        is_bot = obj.get("is_bot") is True
+        is_user = "is_bot" in obj and not is_bot
+        is_chat = obj.get("type") in CHAT_TYPES and "id" in obj
+        result = {}
+        for _key, value in obj.items():
+            if _key == "id" and self.ids and (is_user or is_chat):
+                value = self.anonymize_id(value)
+            elif _key in NAME_FIELDS and self.names and (is_user or is_chat) and isinstance(value, str):
+                value = self.anonymize_name(_key, value, obj.get("id"))
+            elif _key == "username" and self.names and not is_bot and isinstance(value, str):
+                value = self.anonymize_username(value)
+            elif _key in ("text", "caption") and self.names and isinstance(value, str):
+                value = self.anonymize_full_names(value)
+                value = MENTION_PATTERN.sub(lambda match: "@" + self.anonymize_username(match.group(1)), value)
+            elif _key == "data" and self.ids and isinstance(value, str):
+                value = CALLBACK_NUMBER_PATTERN.sub(
+                    lambda match: str(self.anonymize_id(int(match.group())))
+                    if int(match.group()) >= MIN_CALLBACK_USER_ID else match.group(), value)
+            else:
+                value = self.anonymize(value)
+            result[_key] = value
+        return result
+
+
+class UpdateRecorder:
+    """Appends raw webhook updates with their arrival time to a gzipped JSON lines file."""
+
+    def __init__(self, path: str, bot: Bot, anonymizer: Optional[Anonymizer] = None):
+        self.anonymizer = anonymizer
+        self.lock = threading.Lock()
+        # A new file rather than appending, since a gzip file whose writer was killed has no end-of-stream marker and
+        # anything appended to it can't be read back
+        self.file = gzip.open(path, "xt", encoding="utf-8")
+        atexit.register(self.close)
+        # The bot's own user is kept as is, so the replayer can answer getMe with it
+        anonymized = [option for option in ("ids", "names") if anonymizer is not None and getattr(anonymizer, option)]
+        self.write({"bot": bot.get_me().to_dict(), "anonymized": anonymized})
+
+    @classmethod
+    def from_env(cls, bot: Bot) -> Optional["UpdateRecorder"]:
+        if not RECORD_UPDATES:
+            return None
+        options = {option.strip() for option in RECORD_ANONYMIZE.split(",")}
+        anonymizer = None
+        if options & {"ids", "names"}:
+            salt = RECORD_SALT.encode() if RECORD_SALT else secrets.token_bytes(16)
+            anonymizer = Anonymizer(salt, ids="ids" in options, names="names" in options)
+        path = get_recording_path(RECORD_UPDATES)
+        logging.log(logging.INFO, f"Recording updates to {path} (anonymize: {RECORD_ANONYMIZE})")
+        recorder = cls(path, bot, anonymizer)
+        recorder.close_on_sigterm()
+        return recorder
+
+    def record(self, data: dict):
+        if self.anonymizer is not None:
+            data = self.anonymizer.anonymize_update(data)
+        self.write({"t": time.time(), "update": data})
+
+    def write(self, line: dict):
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(json.dumps(line, separators=(",", ":")) + "\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def close_on_sigterm(self):
+        # Dynos are stopped with SIGTERM, which skips atexit, so the file is closed before the signal is handled as
+        # it would have been. Must be called from the main thread.
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def handle_sigterm(signum, frame):
+            self.close()
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+def get_recording_path(path: str) -> str:
+    name, extension = path, ""
+    for suffix in (".jsonl.gz", ".gz"):
+        if path.endswith(suffix):
+            name, extension = path[:-len(suffix)], suffix
+            break
+    return f"{name}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}{extension}"
+
+
+def read_recording(path: str) -> Iterator[dict]:
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        try:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, zlib.error, json.JSONDecodeError) as e:
+            # The recorder was killed without closing the file, so everything flushed before that is kept
+            logging.log(logging.WARNING, f"{path} ends early, replaying the updates read so far: {e}")
@@ -0,0 +1,121 @@
+import datetime
+
+from typing import Optional
+
+from bson import json_util
+
+
+def load_datetime(value) -> Optional[datetime.datetime]:
+    # Dates read back from Mongo through json_util.dumps come out as {"$date": ...}
+    if isinstance(value, dict):
+        return json_util.object_hook(value)
+    return value
+
+
+class Bill:
+    __slots__ = ("name", "amt", "payer", "participants", "datetime", "equal", "unclaimed", "message_id")
+
+    def __init__(self, name: str, amt: float, payer: int, participants: dict[int, float],
+                 datetime: Optional[datetime.datetime], equal: bool = True, unclaimed: float = 0,
+                 message_id: Optional[int] = None):
+        self.name = name
+        self.amt = amt
+        self.payer = payer
+        self.participants = participants
+        self.datetime = datetime
+        self.equal = equal
+        self.unclaimed = unclaimed
+        self.message_id = message_id
+
+    def encode(self) -> list:
+        # Participants are flattened to [user_id, amount, user_id, amount, ...] to avoid string keys
+        return [self.name, self.amt, self.payer, [x for item in self.participants.items() for x in item],
+                self.datetime, self.equal, self.unclaimed, self.message_id]
+
+    @classmethod
+    def load(cls, obj) -> "Bill":
+        if isinstance(obj, cls):
+            return obj
+        if isinstance(obj, dict):
+            # Bills stored before compact encoding
+            return cls(obj["name"], obj["amt"], obj["payer"],
+                       {int(user_id): amt for user_id, amt in obj["participants"].items()},
+                       load_datetime(obj["datetime"]), obj["equal"], obj["unclaimed"], obj.get("message_id"))
+        name, amt, payer, participants, date, equal, unclaimed, message_id = obj
+        return cls(name, amt, payer, dict(zip(participants[::2], participants[1::2])), load_datetime(date),
+                   equal, unclaimed, message_id)
+
+
+class Payment:
+    __slots__ = ("payee", "payer", "amt", "datetime", "balance")
+
+    def __init__(self, payee: int, payer: int, amt: float, datetime: Optional[datetime.datetime], balance: float):
+        self.payee = payee
+        self.payer = payer
+        self.amt = amt
+        self.datetime = datetime
+        self.balance = balance
+
+    def encode(self) -> list:
+        return [self.payee, self.payer, self.amt, self.datetime, self.balance]
+
+    @classmethod
+    def load(cls, obj) -> "Payment":
+        if isinstance(obj, cls):
+            return obj
+        if isinstance(obj, dict):
+            # Payments stored before compact encoding
+            return cls(obj["payee"], obj["payer"], obj["amt"], load_datetime(obj["datetime"]), obj["balance"])
+        payee, payer, amt, date, balance = obj
+        return cls(payee, payer, amt, load_datetime(date), balance)
+
+
+class MonthStats:
+    """A month's totals for /stats: paid by each payer, consumed by each participant and spent on each description."""
+    __slots__ = ("paid", "consumed", "categories")
+
+    def __init__(self, paid: Optional[dict[int, float]] = None, consumed: Optional[dict[int, float]] = None,
+                 categories: Optional[dict[str, float]] = None):
+        self.paid = paid if paid is not None else {}
+        self.consumed = consumed if consumed is not None else {}
+        self.categories = categories if categories is not None else {}
+
+    def encode(self) -> list:
+        # Flattened like bill participants, which also keeps descriptions such as "007" out of convert_str_keys_to_int
+        return [[x for item in totals.items() for x in item] for totals in (self.paid, self.consumed, self.categories)]
+
+    @classmethod
+    def load(cls, obj) -> "MonthStats":
+        if isinstance(obj, cls):
+            return obj
+        paid, consumed, categories = (dict(zip(totals[::2], totals[1::2])) for totals in obj)
+        return cls(paid, consumed, categories)
+
+
+def encode_default(obj):
+    """json.dumps default that writes bills, payments and /stats rollups in their compact form."""
+    if isinstance(obj, (Bill, Payment, MonthStats)):
+        return obj.encode()
+    return json_util.default(obj)
+
+
+def load_records(chat_data: dict):
+    """Converts the stored bills and payments of a chat into Bill and Payment objects and restores its None debt keys
+    and /stats rollups, in place."""
+    if "debts" in chat_data:
+        # Unclaimed amounts are owed to None, which is stored as the JSON key "null"
+        for debts in chat_data["debts"].values():
+            if "null" in debts:
+                debts[None] = debts.pop("null")
+    if "stats" in chat_data:
+        if all(isinstance(month, list) for month in chat_data["stats"].values()):
+            chat_data["stats"] = {month: MonthStats.load(totals) for month, totals in chat_data["stats"].items()}
+        else:
+            # Rollups stored as dicts may have had their descriptions mangled into ints, so they are dropped and
+            # backfilled from the bills on the next /stats
+            del chat_data["stats"]
+    if "bills" in chat_data:
+        chat_data["bills"] = {int(bill_id): Bill.load(bill) for bill_id, bill in chat_data["bills"].items()}
+    if "payments" in chat_data:
+        chat_data["payments"] = {int(payment_id): Payment.load(payment)
+                                 for payment_id, payment in chat_data["payments"].items()}
@@ -0,0 +1,236 @@
+"""Replays updates recorded with RECORD_UPDATES through the bot's handlers, for benchmarking offline.
+
+Telegram is replaced by a stub that answers every Bot API call locally, and chat data is kept in memory,
+optionally seeded from a mongoexport of the chat_data collection:
+
+    python replay.py updates-20211019T120000-42.jsonl.gz --speed 10 --chat-data chat_data.json
+
+Recordings anonymize chat and user ids by default, so the ids of the seed are anonymized the same way, which needs the
+RECORD_SALT the updates were recorded with.
+
+Messages sent by the stub get made-up ids, so replies to the bot's own prompts may not line up with the
+recording. Handler errors are counted rather than stopping the replay.
+"""
+import argparse
+import collections
+import datetime
+import itertools
+import logging
+import queue
+import statistics
+import threading
+import time
+
+from typing import Tuple, Optional, DefaultDict
+
+from bson import json_util
+from telegram import Update, Bot
+from telegram.ext import BasePersistence, CallbackContext, Dispatcher
+from telegram.ext.utils.types import CDCData, BD, CD, UD, ConversationDict
+
+import bot as handlers
+import persistence
+import recording
+
+STUB_TOKEN = "123456:replay"
+
+
+class StubRequest:
+    """Answers Bot API calls without a network, counting how many of each were made. Stands in for
+    telegram.utils.request.Request, of which Bot only calls post."""
+
+    def __init__(self, bot_user: dict, api_latency: float = 0):
+        self.bot_user = bot_user
+        self.api_latency = api_latency
+        # Users seen in the replayed updates, so get_member returns their (anonymized) names
+        self.users: dict[int, dict] = {}
+        self.calls = collections.Counter()
+        self.message_ids = itertools.count(1 << 30)
+        self.lock = threading.Lock()
+
+    def post(self, url: str, data: dict, timeout: float = None):
+        endpoint = url.rsplit("/", 1)[1]
+        with self.lock:
+            self.calls[endpoint] += 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        if endpoint == "getMe":
+            return self.bot_user
+        if endpoint == "getChatMember":
+            user_id = int(data["user_id"])
+            user = self.users.get(user_id, {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"})
+            return {"status": "member", "user": user}
+        if endpoint in ("getChatMemberCount", "getChatMembersCount"):
+            return len(self.users) + 1
+        if endpoint in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            message_id = data.get("message_id") or next(self.message_ids)
+            return {"message_id": message_id, "date": int(time.time()), "text": data.get("text", ""),
+                    "chat": {"id": int(data["chat_id"]), "type": "group"}, "from": self.bot_user}
+        return True
+
+    def remember_users(self, obj):
+        if isinstance(obj, list):
+            for item in obj:
+                self.remember_users(item)
+        elif isinstance(obj, dict):
+            if "is_bot" in obj and "id" in obj:
+                self.users[obj["id"]] = obj
+            for value in obj.values():
+                self.remember_users(value)
+
+
+class LocalPersistence(BasePersistence):
+    def __init__(self, chat_data: Optional[dict] = None):
+        super().__init__(store_user_data=False, store_chat_data=True, store_bot_data=False, store_callback_data=False)
+        self.chat_data = collections.defaultdict(dict, chat_data or {})
+
+    def get_user_data(self) -> DefaultDict[int, UD]:
+        return collections.defaultdict(dict)
+
+    def get_chat_data(self) -> DefaultDict[int, CD]:
+        return self.chat_data
+
+    def get_bot_data(self) -> BD:
+        return {}
+
+    def get_callback_data(self) -> Optional[CDCData]:
+        pass
+
+    def get_conversations(self, name: str) -> ConversationDict:
+        pass
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        pass
+
+    def update_user_data(self, user_id: int, data: UD) -> None:
+        pass
+
+    def update_chat_data(self, chat_id: int, data: CD) -> None:
+        self.chat_data[chat_id] = data
+
+    def update_bot_data(self, data: BD) -> None:
+        pass
+
+    def update_callback_data(self, data: CDCData) -> None:
+        pass
+
+
+def load_chat_data(path: str) -> dict:
+    chat_data = {}
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                chat_data.update(persistence.load_chat_data(json_util.loads(line)))
+    return chat_data
+
+
+def wait_for_pending_edits():
+    # Debounced edits are sent from timer threads, which may start new timers if rate limited
+    while True:
+        timers = [thread for thread in threading.enumerate() if isinstance(thread, threading.Timer)]
+        if not timers:
+            return
+        for timer in timers:
+            timer.join()
+
+
+def anonymize_chat_data(chat_data: dict, anonymizer: recording.Anonymizer) -> dict:
+    anonymize_id = anonymizer.anonymize_id
+    anonymized = {}
+    for chat_id, data in chat_data.items():
+        if "registered" in data:
+            data["registered"] = [anonymize_id(user_id) for user_id in data["registered"]]
+        if "debts" in data:
+            # Unclaimed amounts are owed to None
+            data["debts"] = {anonymize_id(user_id): {other_id if other_id is None else anonymize_id(other_id): amt
+                                                     for other_id, amt in debts.items()}
+                             for user_id, debts in data["debts"].items()}
+        for bill in data.get("bills", {}).values():
+            bill.payer = anonymize_id(bill.payer)
+            bill.participants = {anonymize_id(user_id): amt for user_id, amt in bill.participants.items()}
+        for payment in data.get("payments", {}).values():
+            payment.payee = anonymize_id(payment.payee)
+            payment.payer = anonymize_id(payment.payer)
+        for month in data.get("stats", {}).values():
+            month.paid = {anonymize_id(user_id): amt for user_id, amt in month.paid.items()}
+            month.consumed = {anonymize_id(user_id): amt for user_id, amt in month.consumed.items()}
+        anonymized[anonymize_id(chat_id)] = data
+    return anonymized
+
+
+def replay(path: str, speed: float = 1, api_latency: float = 0, chat_data: Optional[dict] = None,
+           salt: Optional[str] = None):
+    records = recording.read_recording(path)
+    header = next(records, None)
+    if header is None:
+        print(f"No updates could be read from {path}")
+        return
+    # Recordings from before the header listed what was anonymized used the default settings
+    if chat_data and "ids" in header.get("anonymized", ("ids", "names")):
+        if salt is None:
+            raise ValueError(f"{path} was recorded with anonymized ids, so the chat data can only be matched to it "
+                             f"with the RECORD_SALT it was recorded with")
+        chat_data = anonymize_chat_data(chat_data, recording.Anonymizer(salt.encode()))
+    request = StubRequest(header["bot"], api_latency)
+    bot = Bot(token=STUB_TOKEN, request=request)
+    dispatcher = Dispatcher(bot, queue.Queue(), persistence=LocalPersistence(chat_data))
+    handlers.add_handlers(dispatcher)
+    errors = []
+
+    def count_error(update: object, context: CallbackContext):
+        errors.append(context.error)
+
+    dispatcher.add_error_handler(count_error)
+
+    latencies = []
+    start = time.perf_counter()
+    first_t = None
+    for record in records:
+        if "bot" in record:
+            # Recordings made before each process wrote its own file were appended to after a restart
+            continue
+        if first_t is None:
+            first_t = record["t"]
+        arrival = start + (record["t"] - first_t) / speed if speed else time.perf_counter()
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        request.remember_users(record["update"])
+        dispatcher.process_update(Update.de_json(record["update"], bot))
+        latencies.append(time.perf_counter() - arrival)
+    elapsed = time.perf_counter() - start
+    wait_for_pending_edits()
+
+    print(f"Updates: {len(latencies)} in {datetime.timedelta(seconds=elapsed)}"
+          f" ({len(latencies) / elapsed if elapsed else 0:.1f}/s), handler errors: {len(errors)}")
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        print(f"Latency: p50 {percentiles[49] * 1000:.1f} ms, p95 {percentiles[94] * 1000:.1f} ms, "
+              f"p99 {percentiles[98] * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms")
+    print("Bot API calls: " + ", ".join(f"{endpoint} {count}" for endpoint, count in request.calls.most_common()))
+    for error in collections.Counter(repr(error) for error in errors).most_common(5):
+        print(f"  {error[1]} x {error[0]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("recording", help="gzipped JSON lines file written with RECORD_UPDATES")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="replay speed relative to the recording, or 0 for as fast as possible (default: 1)")
+    parser.add_argument("--api-latency", type=float, default=0,
+                        help="seconds each stubbed Bot API call takes (default: 0)")
+    parser.add_argument("--chat-data", help="mongoexport of the chat_data collection to start from")
+    parser.add_argument("--salt", default=recording.RECORD_SALT,
+                        help="RECORD_SALT the recording was made with, to anonymize the chat data's ids to match "
+                             "(default: $RECORD_SALT)")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        replay(args.recording, args.speed, args.api_latency,
+               load_chat_data(args.chat_data) if args.chat_data else None, args.salt)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+if __name__ == "__main__":
+    main()